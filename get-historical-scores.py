@@ -1,75 +1,158 @@
+import asyncio
+import logging
+import httpx
 import requests
-import os
-import json
 import csv
 from pathlib import Path
-from dotenv import load_dotenv
 from datetime import datetime, timedelta
-import time
+from pagevitals_common import (
+    API_BASE_URL, CACHE_DIR, CONNECT_TIMEOUT_SECONDS, CSV_BUFFER_SIZE, CSV_DIR,
+    READ_TIMEOUT_SECONDS, RETRY_AFTER_DEFAULT,
+    HEADERS, configure_logging, fetch_pages, json_dumps, json_loads, log_api_response, map_websites, rate_limiter, write_bytes_atomic
+)
+
+log = logging.getLogger('pagevitals.historical_scores')
 
 # Constants
-API_BASE_URL = 'https://api.pagevitals.com'
-ENV_FILE_PATH = '.env'
-RETRY_AFTER_DEFAULT = 10
-MAX_API_CALLS = 50
-TIME_WINDOW_SECONDS = 10
-CSV_DIR = 'csv'
 HISTORY_DAYS = 90  # Number of days to fetch historical Lighthouse scores
+CONCURRENCY_LIMIT = 16  # Maximum number of timeline requests in flight at once
+FIELDNAMES = ['Page ID', 'Alias', 'URL', 'Device', 'Date', 'LCP', 'FCP', 'Speed Index', 'TBT', 'CLS', 'TTFB', 'TTI', 'DOM Elements', 'DOM Max Depth', 'DOM Ready', 'On Load', 'DNS Time', 'Connect Time', 'Server Time', 'Transfer Time']
 
-# Load environment variables
-load_dotenv()
-
-# Check if API key exists
-api_key = os.getenv('PAGEVITALS_API_KEY')
-if not api_key:
-    print("PAGEVITALS_API_KEY not found in .env file")
-    exit(1)
-
-# API configuration
-headers = {
-    'Authorization': f'Bearer {api_key}',
-    'Content-Type': 'application/json',
-    'User-Agent': 'PageVitals-API-Client/1.0'
-}
-
-def log_api_response(response_data, website_name):
+def get_retry_after(response):
     """
-    Logs the API response to a JSON file.
+    Returns the Retry-After delay of a response in seconds.
+    Falls back to RETRY_AFTER_DEFAULT when the header is missing or given as an HTTP date.
     """
-    log_dir = 'logs'
-    Path(log_dir).mkdir(exist_ok=True)  # Create the logs directory if it doesn't exist
-    log_file = f'{log_dir}/pages_response_{website_name}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-    with open(log_file, 'w') as f:
-        json.dump(response_data, f, indent=2)
-    print(f"\nAPI response logged to: {log_file}")
+    try:
+        return int(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return RETRY_AFTER_DEFAULT
 
-def get_historical_scores(website_id, page_id, start_date, end_date, device):
+async def get_historical_scores(client, sem, website_id, page_id, start_date, end_date, device):
     """
     Fetches the historical scores for a given page, date range, and device.
     """
     scores = []
     full_url = f"{API_BASE_URL}/{website_id}/pages/{page_id}/timeline?startDate={start_date}&endDate={end_date}&device={device}"
-    print(f"\nMaking API call to: {full_url}")
+    log.debug("making API call to %s", full_url)
 
     try:
-        response = requests.get(full_url, headers=headers)
-        if response.status_code == 429:
-            retry_after = int(response.headers.get('Retry-After', RETRY_AFTER_DEFAULT))
-            print(f"\nRate limit exceeded. Waiting {retry_after} seconds...")
-            time.sleep(retry_after)
-            response = requests.get(full_url, headers=headers)
+        async with sem:
+            await asyncio.to_thread(rate_limiter.wait_if_needed)
+            response = await client.get(full_url)
+            if response.status_code == 429:
+                retry_after = get_retry_after(response)
+                log.debug("rate limit exceeded, retrying in %ss", retry_after)
+                await asyncio.sleep(retry_after)
+                await asyncio.to_thread(rate_limiter.wait_if_needed)
+                response = await client.get(full_url)
 
         if response.status_code == 200:
-            response_data = response.json()
-            scores = response_data['result']
-            print(f"API response received.")
+            try:
+                response_data = json_loads(response.content)
+            except ValueError as e:  # A malformed body only loses this page's timeline, not the whole site
+                print(f"Invalid JSON in timeline response for page {page_id}: {e}")
+            else:
+                scores = response_data['result']
+                log.debug("timeline response received for page %s", page_id)
         else:
             print(f"Error fetching scores for page {page_id}: {response.status_code} - {response.text}")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Request failed: {e}")
 
     return scores
 
+def get_cache_path(website_id, page_id, device):
+    """
+    Returns the path of the timeline cache file for a given page and device.
+    """
+    return Path(CACHE_DIR) / f'timeline_{website_id}_{page_id}_{device}.json'
+
+def load_cached_scores(website_id, page_id, device):
+    """
+    Loads the previously fetched timeline scores for a page, or an empty list if none are cached.
+    """
+    cache_path = get_cache_path(website_id, page_id, device)
+    if not cache_path.exists():
+        return []
+    try:
+        return json_loads(cache_path.read_bytes())
+    except ValueError:
+        print(f"Ignoring unreadable timeline cache: {cache_path}")
+        return []  # Treat a corrupt cache file as a miss; it is rewritten once the scores are fetched
+
+def save_cached_scores(website_id, page_id, device, scores):
+    """
+    Saves the timeline scores for a page so the next run only has to fetch newer dates.
+    """
+    cache_path = get_cache_path(website_id, page_id, device)
+    cache_path.parent.mkdir(exist_ok=True)  # Create the cache directory if it doesn't exist
+    write_bytes_atomic(cache_path, json_dumps(scores))
+
+async def get_page_scores(client, sem, website_id, page, start_date, end_date):
+    """
+    Returns the page and its timeline scores, only fetching dates that aren't already cached.
+    The most recent cached date is always fetched again since its data may have been incomplete.
+    """
+    page_id, device = page['id'], page['device']
+    cached_scores = [score for score in load_cached_scores(website_id, page_id, device) if score['date'][:10] >= start_date]
+    fetch_start_date = max(score['date'][:10] for score in cached_scores) if cached_scores else start_date
+
+    new_scores = await get_historical_scores(client, sem, website_id, page_id, fetch_start_date, end_date, device)
+    if not new_scores:
+        return page, cached_scores
+
+    scores = [score for score in cached_scores if score['date'][:10] < fetch_start_date] + new_scores
+    save_cached_scores(website_id, page_id, device, scores)
+    return page, scores
+
+def get_score_rows(page, historical_scores):
+    """
+    Yields one CSV row per historical score of a page, in FIELDNAMES order.
+    """
+    page_id, alias, url, device = page['id'], page['alias'], page['url'], page['device']
+    for score in historical_scores:
+        yield (
+            page_id,
+            alias,
+            url,
+            device,
+            score['date'],
+            score.get('lcp', 'N/A'),
+            score.get('fcp', 'N/A'),
+            score.get('speed_index', 'N/A'),
+            score.get('tbt', 'N/A'),
+            score.get('cls', 'N/A'),
+            score.get('ttfb', 'N/A'),
+            score.get('tti', 'N/A'),
+            score.get('dom_elements', 'N/A'),
+            score.get('dom_max_depth', 'N/A'),
+            score.get('dom_ready', 'N/A'),
+            score.get('on_load', 'N/A'),
+            score.get('dns_time', 'N/A'),
+            score.get('connect_time', 'N/A'),
+            score.get('server_time', 'N/A'),
+            score.get('transfer_time', 'N/A')
+        )
+
+async def write_scores(writer, pages, website_id):
+    """
+    Fetches the historical scores for all pages concurrently and writes each page's rows
+    as soon as its response arrives, so only in-flight timelines are held in memory.
+    """
+    start_date = (datetime.now() - timedelta(days=HISTORY_DAYS)).strftime('%Y-%m-%d')
+    end_date = datetime.now().strftime('%Y-%m-%d')
+    sem = asyncio.Semaphore(CONCURRENCY_LIMIT)
+
+    # HTTP/2 multiplexes all timeline requests over a single connection when the server supports it
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    timeout = httpx.Timeout(READ_TIMEOUT_SECONDS, connect=CONNECT_TIMEOUT_SECONDS)
+    async with httpx.AsyncClient(http2=True, headers=HEADERS, timeout=timeout, limits=limits) as client:
+        tasks = [get_page_scores(client, sem, website_id, page, start_date, end_date) for page in pages]
+        for task in asyncio.as_completed(tasks):
+            page, historical_scores = await task
+            writer.writerows(get_score_rows(page, historical_scores))
+
 def write_pages_to_csv(pages, website_name, website_id):
     """
     Writes the page data, including historical scores, to a CSV file.
@@ -77,61 +160,37 @@ def write_pages_to_csv(pages, website_name, website_id):
     csv_path = Path(CSV_DIR) / f'{website_name}_pages_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
     csv_path.parent.mkdir(exist_ok=True)  # Create the csv directory if it doesn't exist
 
-    with open(csv_path, 'w', newline='') as csvfile:
-        fieldnames = ['Page ID', 'Alias', 'URL', 'Device', 'Date', 'LCP', 'FCP', 'Speed Index', 'TBT', 'CLS', 'TTFB', 'TTI', 'DOM Elements', 'DOM Max Depth', 'DOM Ready', 'On Load', 'DNS Time', 'Connect Time', 'Server Time', 'Transfer Time']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for page in pages:
-            page_id = page['id']
-            start_date = (datetime.now() - timedelta(days=HISTORY_DAYS)).strftime('%Y-%m-%d')
-            end_date = datetime.now().strftime('%Y-%m-%d')
-            historical_scores = get_historical_scores(website_id, page_id, start_date, end_date, page['device'])
-
-            for score in historical_scores:
-                row = {
-                    'Page ID': page['id'],
-                    'Alias': page['alias'],
-                    'URL': page['url'],
-                    'Device': page['device'],
-                    'Date': score['date'],
-                    'LCP': score.get('lcp', 'N/A'),
-                    'FCP': score.get('fcp', 'N/A'),
-                    'Speed Index': score.get('speed_index', 'N/A'),
-                    'TBT': score.get('tbt', 'N/A'),
-                    'CLS': score.get('cls', 'N/A'),
-                    'TTFB': score.get('ttfb', 'N/A'),
-                    'TTI': score.get('tti', 'N/A'),
-                    'DOM Elements': score.get('dom_elements', 'N/A'),
-                    'DOM Max Depth': score.get('dom_max_depth', 'N/A'),
-                    'DOM Ready': score.get('dom_ready', 'N/A'),
-                    'On Load': score.get('on_load', 'N/A'),
-                    'DNS Time': score.get('dns_time', 'N/A'),
-                    'Connect Time': score.get('connect_time', 'N/A'),
-                    'Server Time': score.get('server_time', 'N/A'),
-                    'Transfer Time': score.get('transfer_time', 'N/A')
-                }
-                writer.writerow(row)
+    with open(csv_path, 'w', newline='', buffering=CSV_BUFFER_SIZE, encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(FIELDNAMES)
+        asyncio.run(write_scores(writer, pages, website_id))
 
     print(f"Page data written to CSV: {csv_path}")
 
+def process_site(website_name, website_id):
+    """
+    Fetches the pages for a single website and writes their historical scores to CSV.
+    """
+    print(f"Fetching pages for website: {website_name} (ID: {website_id})")
+    try:
+        pages_data = fetch_pages(website_id)
+    except requests.exceptions.RequestException as e:
+        print(f"Request failed: {e}")
+        exit(1)
+    except ValueError as e:  # json_loads errors are not RequestExceptions, unlike response.json()
+        print(f"Invalid JSON in API response: {e}")
+        exit(1)
+
+    if pages_data is not None:
+        pages = pages_data['result']['list']
+        log_api_response(pages_data, f'pages_response_{website_name}')
+        write_pages_to_csv(pages, website_name, website_id)
+
 if __name__ == "__main__":
     """
     Main execution of the script.
     """
-    # Loop through all environment variables that start with PAGEVITALS_WEBSITE_
-    for key, value in os.environ.items():
-        if key.startswith('PAGEVITALS_WEBSITE_'):
-            website_name = key.split('PAGEVITALS_WEBSITE_')[1]
-            website_id = value
-            print(f"Fetching pages for website: {website_name} (ID: {website_id})")
-            pages_url = f"{API_BASE_URL}/{website_id}/pages"
-            pages_response = requests.get(pages_url, headers=headers)
-            
-            if pages_response.status_code == 200:
-                pages_data = pages_response.json()
-                pages = pages_data['result']['list']
-                log_api_response(pages_data, website_name)
-                write_pages_to_csv(pages, website_name, website_id)
-            else:
-                print(f"Error fetching pages for website {website_name}: {pages_response.status_code} - {pages_response.text}")
\ No newline at end of file
+    configure_logging()
+
+    # Process websites concurrently; each one writes to its own CSV and log files
+    map_websites(process_site)
\ No newline at end of file
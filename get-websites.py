@@ -3,141 +3,100 @@ import os
 import stat
 from pathlib import Path
 import re
-from dotenv import load_dotenv
+import string
 import secrets
-import json
-from datetime import datetime, timedelta
-import time
+from pagevitals_common import (
+    API_BASE_URL, ENV_FILE_PATH, REQUEST_TIMEOUT, WEBSITE_ENV_PREFIX,
+    SESSION, configure_logging, json_loads, log_api_response, rate_limiter
+)
 
 # Constants
-API_BASE_URL = 'https://api.pagevitals.com'
-ENV_FILE_PATH = '.env'
-LOG_DIR_PATH = 'logs'
-LOG_FILE_PREFIX = 'websites_response_'
-RETRY_AFTER_DEFAULT = 10
-MAX_API_CALLS = 50
-TIME_WINDOW_SECONDS = 10
-
-def secure_file_permissions(filepath):
-    """Set secure file permissions for the .env file"""
-    os.chmod(filepath, stat.S_IRUSR)
-    if os.name == 'posix' and os.stat(filepath).st_uid != os.getuid():
-        raise PermissionError("File ownership mismatch")
+WEBSITES_URL = f'{API_BASE_URL}/websites'
+
+class _AsciiAlnumTable(dict):
+    """str.translate table that keeps ASCII letters and digits and deletes every other character"""
+    def __missing__(self, codepoint):
+        self[codepoint] = None  # Remember the deletion so repeated characters are a plain dict hit
+        return None
+
+# Cleans display names into env variable suffixes, equivalent to re.sub(r'[^a-zA-Z0-9]', '', name)
+_ALNUM_TABLE = _AsciiAlnumTable((ord(c), ord(c)) for c in string.ascii_letters + string.digits)
+
+# Precompiled pattern used once per website field
+_WORDS_RE = re.compile(r'[A-Z]*[a-z0-9]+')  # Words of a camelCase API key
 
 def update_env_file(websites=None):
     """Safely update .env file with individual website IDs, preserving the API key"""
     env_path = Path(ENV_FILE_PATH)
     temp_path = env_path.with_suffix('.tmp.' + secrets.token_hex(16))  # Create temp path directly
     
+    existing_text = ''  # Current contents of the .env file
     existing_ids = set()  # To store existing website IDs
     if env_path.exists():
-        with open(env_path) as f:
-            existing_lines = f.readlines()
-            existing_ids = {line.split('=')[0] for line in existing_lines}  # Extract existing IDs
+        existing_text = env_path.read_text()  # Read the whole file in one call
+        existing_ids = {line.split('=', 1)[0] for line in existing_text.splitlines()}  # Extract existing IDs
     
-    new_ids_added = False  # Track if new IDs are added
+    new_lines = []  # Website entries that are not in the .env file yet
+    if websites:
+        for website in websites:
+            site_name = website['displayName'].upper().translate(_ALNUM_TABLE)
+            env_key = f'{WEBSITE_ENV_PREFIX}{site_name}'
+            if env_key not in existing_ids:  # Check if ID already exists
+                new_lines.append(f'{env_key}={website["id"]}\n')
 
-    with open(temp_path, 'w') as f:
-        f.writelines(existing_lines)  # Write existing lines back to the temp file
-        
-        if websites:
-            for website in websites:
-                site_name = re.sub(r'[^a-zA-Z0-9]', '', website['displayName'].upper())
-                env_variable = f'PAGEVITALS_WEBSITE_{site_name}={website["id"]}\n'
-                if env_variable.split('=')[0] not in existing_ids:  # Check if ID already exists
-                    f.write(env_variable)
-                    new_ids_added = True  # Mark that a new ID was added
-    
-    secure_file_permissions(temp_path)
-    temp_path.replace(env_path)
-    temp_path.unlink(missing_ok=True)  # Safely unlink the temp file
+    if not new_lines:
+        return False  # Nothing to add, so leave the .env file untouched
 
-    return new_ids_added  # Return whether new IDs were added
+    if existing_text and not existing_text.endswith('\n'):
+        existing_text += '\n'  # Keep the first new entry off the last existing line
 
-def log_api_response(response_data):
-    """Log API response to a timestamped file in a logs directory"""
-    log_dir = Path(LOG_DIR_PATH)
-    log_dir.mkdir(exist_ok=True)
-    log_file = log_dir / f'{LOG_FILE_PREFIX}{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-    
-    with open(log_file, 'w') as f:
-        json.dump(response_data, f, indent=2)
-    
-    print(f"\nAPI response logged to: {log_file}")
-
-class RateLimiter:
-    """Simple rate limiter to respect API limits of 50 calls per 10 seconds"""
-    def __init__(self, max_calls=50, time_window=10):
-        self.max_calls = max_calls
-        self.time_window = time_window
-        self.calls = []
-
-    def wait_if_needed(self):
-        """Check if we need to wait before making another API call"""
-        now = datetime.now()
-        self.calls = [call_time for call_time in self.calls if now - call_time < timedelta(seconds=self.time_window)]
-        
-        if len(self.calls) >= self.max_calls:
-            sleep_time = (min(self.calls) + timedelta(seconds=self.time_window) - now).total_seconds()
-            if sleep_time > 0:
-                print(f"\nRate limit approached. Waiting {sleep_time:.2f} seconds...")
-                time.sleep(sleep_time)
-        
-        self.calls.append(now)
+    # Create the temp file owner-read-only from the start; O_EXCL refuses to follow a pre-planted file or symlink
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, stat.S_IRUSR)
+    try:
+        # No fsync: this is a tiny config file and the atomic rename below already prevents a half-written .env
+        with os.fdopen(fd, 'w') as f:
+            f.write(existing_text + ''.join(new_lines))  # Write the whole file in a single call
+
+        temp_path.replace(env_path)  # Renames the temp file away, so there is nothing left to clean up
+    except BaseException:
+        temp_path.unlink(missing_ok=True)  # Only reached when the temp file was not renamed into place
+        raise
+
+    return True  # New IDs were added
 
 # Check if .env exists
 if not Path(ENV_FILE_PATH).exists():
     print(f"No {ENV_FILE_PATH} file found. Copy .env.example and add the API key to PAGEVITALS_API_KEY.")
     exit(1)
 
-# Load environment variables
-load_dotenv()
-
-# Check if API key exists
-api_key = os.getenv('PAGEVITALS_API_KEY')
-if not api_key:
-    print("PAGEVITALS_API_KEY not found in .env file")
-    exit(1)
-
-# API configuration
-headers = {
-    'Authorization': f'Bearer {api_key}',
-    'Content-Type': 'application/json',
-    'User-Agent': 'PageVitals-API-Client/1.0'
-}
-
-# Create rate limiter instance
-rate_limiter = RateLimiter(max_calls=MAX_API_CALLS, time_window=TIME_WINDOW_SECONDS)
+configure_logging()
 
 # Get list of websites
-full_url = f'{API_BASE_URL}/websites'
-print(f"\nMaking API call to: {full_url}")
+print(f"\nMaking API call to: {WEBSITES_URL}")
 
 # Check rate limit before making the call
 rate_limiter.wait_if_needed()
 
 try:
-    response = requests.get(full_url, headers=headers)
-    
-    if response.status_code == 429:
-        retry_after = int(response.headers.get('Retry-After', RETRY_AFTER_DEFAULT))
-        print(f"\nRate limit exceeded. Waiting {retry_after} seconds...")
-        time.sleep(retry_after)
-        rate_limiter.wait_if_needed()
-        response = requests.get(full_url, headers=headers)
+    response = SESSION.get(WEBSITES_URL, timeout=REQUEST_TIMEOUT)
     
     if response.status_code == 200:
-        response_data = response.json()
+        response_data = json_loads(response.content)
         websites = response_data['result']['list']
-        log_api_response(response_data)
+        log_api_response(response_data, 'websites_response')
         
         print("\nFound websites:")
+        display_keys = {}  # Websites share the same fields, so each key is only turned into a label once
         for website in websites:
-            print("\nWebsite Details:")
+            # Build each website's details block first so it is printed with a single call
+            lines = ["\nWebsite Details:"]
             for key, value in website.items():
-                display_key = ' '.join(word.capitalize() for word in re.findall(r'[A-Z]*[a-z0-9]+', key))
-                print(f"{display_key}: {value}")
-            print("-" * 50)
+                display_key = display_keys.get(key)
+                if display_key is None:
+                    display_key = display_keys[key] = ' '.join(word.capitalize() for word in _WORDS_RE.findall(key))
+                lines.append(f"{display_key}: {value}")
+            lines.append("-" * 50)
+            print('\n'.join(lines))
         
         new_ids_added = update_env_file(websites)
         
@@ -148,4 +107,7 @@ try:
 
 except requests.exceptions.RequestException as e:
     print(f"Request failed: {e}")
+    exit(1)
+except ValueError as e:  # json_loads errors are not RequestExceptions, unlike response.json()
+    print(f"Invalid JSON in API response: {e}")
     exit(1)
\ No newline at end of file
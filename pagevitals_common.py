@@ -0,0 +1,223 @@
+#Shared configuration, HTTP session and helpers used by all PageVitals scripts
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
+import gzip
+from functools import cache
+from pathlib import Path
+from types import MappingProxyType
+from dotenv import load_dotenv
+from datetime import datetime
+import threading
+import time
+import logging
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson is much faster at both parsing and serializing, but the scripts still work with the standard library
+try:
+    import orjson
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    import json
+
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        """Serializes obj to compact JSON bytes, matching orjson.dumps"""
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+# Per-call diagnostics go to this logger; they cost a single level check unless DEBUG is enabled.
+# The scripts log under child names such as 'pagevitals.historical_scores', so one switch covers them all
+log = logging.getLogger('pagevitals')
+
+# Constants
+API_BASE_URL = 'https://api.pagevitals.com'
+ENV_FILE_PATH = '.env'
+WEBSITE_ENV_PREFIX = 'PAGEVITALS_WEBSITE_'
+DEBUG_ENV_VAR = 'PAGEVITALS_DEBUG'  # Set to any non-empty value to print the per-call DEBUG messages
+LOG_DIR_PATH = 'logs'
+LOG_COMPRESSION_LEVEL = 3  # Logs are debug artifacts, so favour speed over ratio
+RETRY_AFTER_DEFAULT = 10
+CONNECT_TIMEOUT_SECONDS = 3.05  # Slightly above a multiple of the 3 s TCP retransmission window
+READ_TIMEOUT_SECONDS = 30
+REQUEST_TIMEOUT = (CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS)
+MAX_API_CALLS = 50
+TIME_WINDOW_SECONDS = 10
+CSV_DIR = 'csv'
+CACHE_DIR = 'cache'  # Previously fetched API data, reused across runs
+CSV_BUFFER_SIZE = 1 << 20  # 1 MiB write buffer for CSV output
+MAX_WORKERS = 16  # Maximum number of websites processed concurrently
+
+# Load environment variables
+load_dotenv()
+
+# Check if API key exists
+api_key = os.getenv('PAGEVITALS_API_KEY')
+if not api_key:
+    if not Path(ENV_FILE_PATH).exists():
+        print(f"No {ENV_FILE_PATH} file found. Copy .env.example and add the API key to PAGEVITALS_API_KEY.")
+    else:
+        print("PAGEVITALS_API_KEY not found in .env file")
+    exit(1)
+
+# API configuration, read-only so the headers bound to the HTTP clients can't drift
+HEADERS = MappingProxyType({
+    'Authorization': f'Bearer {api_key}',
+    'Content-Type': 'application/json',
+    'User-Agent': 'PageVitals-API-Client/1.0'
+})
+
+class RateLimiter:
+    """Simple thread-safe token bucket rate limiter to respect API limits of 50 calls per 10 seconds"""
+    def __init__(self, max_calls=50, time_window=10):
+        # Holding a single token and refilling the other max_calls - 1 evenly over the window caps any span of
+        # time_window seconds at max_calls calls while keeping sustained throughput close to the full quota
+        self.capacity = 1
+        self.rate = (max_calls - self.capacity) / time_window  # Tokens added per second
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait_if_needed(self):
+        """Take a token for the next API call, waiting for one to be refilled if the bucket is empty"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            # Reserve the token up front; a negative balance queues this call behind earlier reservations
+            self.tokens -= 1
+            sleep_time = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        # Sleep outside the lock so other threads can take or reserve tokens meanwhile
+        if sleep_time > 0:
+            log.debug("rate limit sleep %.2fs", sleep_time)
+            time.sleep(sleep_time)
+
+# Create rate limiter instance shared by all threads
+rate_limiter = RateLimiter(max_calls=MAX_API_CALLS, time_window=TIME_WINDOW_SECONDS)
+
+class RateLimitedRetry(Retry):
+    """Retry policy whose re-sent requests also take a token from the shared rate limiter"""
+    def sleep(self, response=None):
+        super().sleep(response)  # Honours Retry-After or the backoff delay first
+        rate_limiter.wait_if_needed()
+
+# Shared HTTP session so every API call reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)  # Bound once; requests merges them into every call
+# Retries honour Retry-After on 429s and back off on transient server errors, all on the pooled connection,
+# and count against the rate limiter like any other call
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=RateLimitedRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        respect_retry_after_header=True,
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False
+    )
+))
+
+def configure_logging():
+    """
+    Prints warnings and errors to stderr, plus the PageVitals DEBUG messages when PAGEVITALS_DEBUG is set.
+    Only the 'pagevitals' loggers are lowered to DEBUG, so the HTTP libraries stay quiet.
+    """
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(name)s: %(message)s')
+    if os.getenv(DEBUG_ENV_VAR):
+        log.setLevel(logging.DEBUG)
+
+def log_api_response(response_data, log_name):
+    """
+    Logs the API response to a timestamped, gzip-compressed JSON file in the logs directory.
+    """
+    log_dir = Path(LOG_DIR_PATH)
+    log_dir.mkdir(exist_ok=True)  # Create the logs directory if it doesn't exist
+    log_file = log_dir / f'{log_name}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json.gz'
+    with gzip.open(log_file, 'wb', compresslevel=LOG_COMPRESSION_LEVEL) as f:
+        f.write(json_dumps(response_data))  # Compact JSON; pipe through a formatter such as jq to read it
+    print(f"\nAPI response logged to: {log_file}")
+
+@cache
+def iter_websites():
+    """
+    Returns the (name, ID) pairs of all PAGEVITALS_WEBSITE_ environment variables, sorted by name.
+    The environment is only scanned once per process.
+    """
+    prefix_length = len(WEBSITE_ENV_PREFIX)
+    return tuple(sorted((key[prefix_length:], value) for key, value in os.environ.items() if key.startswith(WEBSITE_ENV_PREFIX)))
+
+def map_websites(process_site):
+    """
+    Calls process_site(website_name, website_id) for every configured website and returns the results in order.
+    The websites are processed on a thread pool, so their API calls overlap on the pooled SESSION connections
+    while the shared rate limiter keeps them within the API quota.
+    """
+    sites = iter_websites()
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(sites)))) as executor:
+        return list(executor.map(lambda site: process_site(*site), sites))
+
+def write_bytes_atomic(path, data):
+    """
+    Writes data to path through a temp file that is then renamed into place,
+    so an interrupted run can never leave a truncated file behind.
+    """
+    temp_path = path.with_name(f'{path.name}.tmp.{secrets.token_hex(16)}')
+    try:
+        temp_path.write_bytes(data)
+        temp_path.replace(path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)  # Only reached when the temp file was not renamed into place
+        raise
+
+def get_pages_cache_path(website_id):
+    """
+    Returns the path of the cached pages list and its ETag for a given website.
+    """
+    return Path(CACHE_DIR) / f'pages_{website_id}.json'
+
+def fetch_pages(website_id):
+    """
+    Fetches the pages list for a website and returns the decoded response, or None if the API returned an error.
+    The ETag of the previously cached list is sent as If-None-Match, so an unchanged list comes back as
+    304 Not Modified and is served from the cache instead of being downloaded and decoded again.
+    """
+    full_url = f'{API_BASE_URL}/{website_id}/pages'
+    print(f"\nMaking API call to: {full_url}")
+
+    cache_path = get_pages_cache_path(website_id)
+    cached = None
+    if cache_path.exists():
+        try:
+            cached = json_loads(cache_path.read_bytes())
+        except ValueError:
+            pass
+        if not (isinstance(cached, dict) and 'etag' in cached and 'response' in cached):
+            print(f"Ignoring unreadable pages cache: {cache_path}")  # Falls back to an unconditional GET
+            cached = None
+    request_headers = {'If-None-Match': cached['etag']} if cached else None
+
+    # Check rate limit before making the call
+    rate_limiter.wait_if_needed()
+    response = SESSION.get(full_url, headers=request_headers, timeout=REQUEST_TIMEOUT)
+
+    if response.status_code == 304 and cached:
+        print(f"Pages for website {website_id} are unchanged, using the cached list.")
+        return cached['response']
+
+    if response.status_code == 200:
+        response_data = json_loads(response.content)
+        etag = response.headers.get('ETag')
+        if etag:
+            cache_path.parent.mkdir(exist_ok=True)  # Create the cache directory if it doesn't exist
+            write_bytes_atomic(cache_path, json_dumps({'etag': etag, 'response': response_data}))
+        return response_data
+
+    print(f"Error fetching pages for website {website_id}: {response.status_code} - {response.text}")
+    return None